@@ -2,62 +2,105 @@
 """
 Information and function to read from the EPA's Toxic Release Inventory
 
-Used to support the notebook TRI_API.ipynb
+Used to support the notebook TRI_API.ipynb, which imports hvplot.pandas itself for plotting
 
 This is based off of the project 
 https://github.com/kperry2215/pull_data_from_EPA_Envirofacts_API
 
 """
-import hvplot.pandas
-import pandas as pd
 import io
+import pandas as pd
+import re
 import requests
-from bs4 import BeautifulSoup # parse some xml returned 
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pandas.api.types import is_categorical_dtype, union_categoricals
 from progress.bar import Bar
+from tri_constants import WM_DICT
+
+# kept under its original name for code that read it from this module
+wm_dict = WM_DICT
+
+# fix the types of the low-cardinality text columns rather than inferring them per chunk
+DTYPES = {'TRI_TRANSFER_QTY.TYPE_OF_WASTE_MANAGEMENT':'category',
+          'TRI_FACILITY.STATE_ABBR':'category',
+         }
+
+# share one session between calls so the chunk downloads reuse the connection
+_SESSION = requests.Session()
+_POOL_SIZE = 10 # connections kept alive, TRI_Query never runs more downloads than this
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=_POOL_SIZE,
+                                       max_retries=Retry(total=3, backoff_factor=0.3,
+                                                         status_forcelist=(502, 503, 504))))
+_TIMEOUT = (5, 60) # (connect, read) seconds
+_CSV_TIMEOUT = (5, 120) # pages of records take longer to send than the count
+
+class _LineCounter(io.RawIOBase):
+    """Read-only stream that counts the lines of a response as pandas reads them"""
+    def __init__(self, raw):
+        self.raw = raw
+        self.lines = 0
+        self.last = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.raw.read(len(b))
+        b[:len(data)] = data
+        if data:
+            self.lines += data.count(b'\n')
+            self.last = data[-1:]
+        return len(data)
+
+    def records(self):
+        """Number of records the server sent, not counting the header line"""
+        lines = self.lines + (self.last not in (b'', b'\n'))
+        return max(lines - 1, 0)
 
-wm_dict = {'P91':'Waste water treatment',
-           'M56':'Energy Recovery',
-           'M50':'Incineration/Thermal Treatment',
-           'M64':'Other Landfills',
-           'M24':'Metals Recovery',
-           'M26':'Other Reuse or Recovery',
-           'M41':'Solidification/Stabilization - Metals and Metal Category Compounds only',
-           'M90':'Other Off-Site Management',
-           'M61':'Wastewater Treatment (Excluding POTW)',
-           'M93':'Transfer to Waste Broker - Recycling ',
-           'M92':'Transfer to Waste Broker - Energy Recovery',
-           'M94':'Transfer to Waste Broker - Disposal',
-           'M20':'Solvents/Organics Recovery',
-           'M99':'Unknown',
-           'M54':'Incineration/Insignificant Fuel Value ',
-           'M95':'Transfer to Waste Broker - Waste Treatment',
-           'M62':'Wastewater Treatment (Excluding POTW) - Metals and Metal Category Compounds only',
-           'M79':'Other Land Disposal',
-           'M65':'RCRA Subtitle C Landfills',
-           'M69':'Other Waste Treatment',
-           'M40':'Solidification/Stabilization',
-           'M73':'Land Treatment',
-           'M10':'Storage Only',
-           'M81':'Underground Injection to Class I Wells',
-           'M66':'Subtitle C Surface Impoundment',
-           'M67':'Other Surface Impoundments',
-           'M28':'Acid Regeneration',
-           'M82':'Underground Injection to Class II- V Wells',
-           'M72':'Landfill/Disposal Surface Impoundment'
-          }
+def _read_chunk(url):
+    """Stream one CSV response from the API straight into pandas
+    
+    Returns the dataframe and the number of records the server sent, which is
+    larger than the dataframe when bad lines were skipped.
+    """
+    with _SESSION.get(url, stream=True, timeout=_CSV_TIMEOUT) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True # let urllib3 undo any gzip/deflate
+        stream = _LineCounter(r.raw)
+        frame = pd.read_csv(stream, engine='c', encoding='utf-8',
+                            error_bad_lines=False, low_memory=False, dtype=DTYPES)
+        return frame, stream.records()
+
+def _read_range(query, first, last, output_format):
+    """Download rows first to last, asking again for any tail the server held back"""
+    frames = []
+    while first <= last:
+        # the API treats 'rows/first:last/' as inclusive of both ends
+        frame, sent = _read_chunk(query+'rows/'+str(first)+':'+str(last)+'/'+output_format)
+        frames.append(frame)
+        if sent == 0:
+            break
+        first += sent
+    return frames
 
-def TRI_Query(state=None, county=None,area_code=None, year=None,chunk_size=100000):
+def TRI_Query(state=None, county=None,area_code=None, year=None,chunk_size=100000,
+              max_workers=8, table_name1='TRI_FACILITY', table_name2='TRI_REPORTING_FORM',
+              table_name3='TRI_TRANSFER_QTY'):
     """Query the EPA Toxic Release Inventory Database
     
     This function constructs a query for the EPA Toxic Release Inventory API, with optional arguments for details such as the two-letter state, county name, area code, and year.  More info here: https://www.epa.gov/enviro/envirofacts-data-service-api
     
+    The records are downloaded in pages of `chunk_size` rows, with up to `max_workers` pages requested at once (at most 10, the size of the connection pool).  A warning is raised if the number of rows received does not match the record count reported by the API.
+    
+    The three joined tables default to the facility, reporting form and transfer quantity tables, and can be swapped through `table_name1`, `table_name2` and `table_name3`.  The state, county and area code filters apply to the first table and the year filter to the second.
+    
     """
     
     base_url='https://data.epa.gov/efservice/'
-    #Declare the names of the tables that we want to pull    
-    table_name1='TRI_FACILITY'
-    table_name2='TRI_REPORTING_FORM'
-    table_name3 = 'TRI_TRANSFER_QTY'
     
     output_format='CSV'
     query = base_url
@@ -80,40 +123,68 @@ def TRI_Query(state=None, county=None,area_code=None, year=None,chunk_size=10000
             query+='reporting_year/'+str(year)+'/'
     #add the third table
     query += table_name3+'/'
-    count_query = query+'count/'
     
-    count_xml = requests.get(count_query).content
-    
-    nrows= int(BeautifulSoup(count_xml,features="lxml").find('requestrecordcount').contents[0])
-    
-    #Add in the desired output format to the query
-    csv_query = query+ output_format
+    # the API treats 'rows/first:last/' as inclusive of both ends
+    first_query = query+'rows/0:'+str(chunk_size-1)+'/'+output_format
+    first_frame, page_size = _read_chunk(first_query)
+    frames=[first_frame]
+    nrows = page_size
+    if nrows > 0:
+        # an empty first page means there are no records; otherwise count them, as
+        # a short page can also come from skipped bad lines or a server side row limit
+        count_query = query+'count/'
+        count_xml = _SESSION.get(count_query, timeout=_TIMEOUT).content
+        # the reply is a tiny xml document, just pull out the one number in it
+        nrows= int(re.search(rb'<requestrecordcount>\s*(\d+)', count_xml, re.IGNORECASE).group(1))
 
-    
-    #Return the completed query
     bar = Bar('Downloading Records:',max=nrows,\
               suffix='%(index)d/%(max)d %(percent).1f%% - %(eta)ds')
     bar.check_tty = False
-    s=requests.get(csv_query).content
-    dataframe=pd.read_csv(io.StringIO(s.decode('utf-8')), engine='python',
-                      encoding='utf-8', error_bad_lines=False)
-    bar.next(n = dataframe.shape[0])
-    nrows_prev = dataframe.shape[0]
-
-    while dataframe.shape[0] < nrows:
-        new_query = query + 'rows/'+str(dataframe.shape[0])+':'\
-                        +str(dataframe.shape[0]+chunk_size)+'/'
-        csv_query = new_query+ output_format
-        s=requests.get(csv_query).content
-        dataframe = dataframe.append(pd.read_csv(io.StringIO(s.decode('utf-8')),
-                                                 engine='python',encoding='utf-8',
-                                                 error_bad_lines=False))
-        bar.next(n=dataframe.shape[0]-nrows_prev)
-        nrows_prev = dataframe.shape[0]
+    bar.next(n=first_frame.shape[0])
+    if nrows > page_size:
+        # the remaining row ranges are known up front, so download them concurrently;
+        # page by what the server sent for the first page in case it caps the rows per
+        # response below chunk_size
+        ranges = [(i, min(i+page_size, nrows)-1) for i in range(page_size, nrows, page_size)]
+        with ThreadPoolExecutor(max_workers=min(max_workers, _POOL_SIZE)) as executor:
+            futures = [executor.submit(_read_range, query, first, last, output_format)
+                       for first, last in ranges]
+            try:
+                # redraw the bar at most every 0.1 s rather than once per page
+                pending, last_draw = 0, time.monotonic()
+                for future in as_completed(futures):
+                    pending += sum(frame.shape[0] for frame in future.result())
+                    if time.monotonic() - last_draw >= 0.1:
+                        bar.next(n=pending)
+                        pending, last_draw = 0, time.monotonic()
+                bar.next(n=pending)
+            except BaseException:
+                # don't wait on the pages that haven't started when one has failed
+                for future in futures:
+                    future.cancel()
+                raise
+        # keep the chunks in row order and concatenate once
+        frames += [frame for future in futures for frame in future.result()]
         
     bar.finish()
-    # do the replacement:
-    if 'TRI_TRANSFER_QTY.TYPE_OF_WASTE_MANAGEMENT' in dataframe.columns:
-        dataframe.replace({'TRI_TRANSFER_QTY.TYPE_OF_WASTE_MANAGEMENT':wm_dict},inplace=True)
+    # pages with different categories would concatenate to object columns, so give
+    # every page the union of the categories first
+    for col in DTYPES:
+        if all(col in frame.columns for frame in frames):
+            categories = union_categoricals([frame[col] for frame in frames]).categories
+            for frame in frames:
+                frame[col] = frame[col].cat.set_categories(categories)
+    dataframe = pd.concat(frames, ignore_index=True, copy=False)
+    # short pages are topped up above, so a shortfall here is from skipped bad lines
+    if dataframe.shape[0] != nrows:
+        warnings.warn('Received '+str(dataframe.shape[0])+' TRI records but the API reported '+
+                      str(nrows)+', some lines could not be read')
+    # do the replacement, only the categories need renaming, not every row:
+    wm_col = 'TRI_TRANSFER_QTY.TYPE_OF_WASTE_MANAGEMENT'
+    if wm_col in dataframe.columns and is_categorical_dtype(dataframe[wm_col]):
+        dataframe[wm_col] = dataframe[wm_col].cat.rename_categories(WM_DICT)
+    elif wm_col in dataframe.columns:
+        # a page was missing the column, so it is no longer categorical
+        dataframe[wm_col] = dataframe[wm_col].map(dict(WM_DICT)).fillna(dataframe[wm_col])
     return dataframe
 
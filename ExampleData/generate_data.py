@@ -1,20 +1,29 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.integrate import solve_ivp
 import pandas as pd
-np.random.seed(8675309) # set random seed
+rng = np.random.RandomState(8675309) # seeded random number generator
 
 expt_info  = pd.read_excel('./condition info.xlsx')
 
-def calc_dummy_data(t,C,P,T):
-    r = -0.1*P*np.exp(5000*(-1/(T+273.15)+1/(300)))*C
-    return(r)
+def calc_rate_constant(P,T):
+    k = -0.1*P*np.exp(5000*(-1/(T+273.15)+1/(300)))
+    return(k)
 
-for ix,e,T,P,c in expt_info.itertuples():
-    c0 = [c]
-    sol = solve_ivp(lambda t,y: calc_dummy_data(t,y,P,T),[0,50],c0,t_eval = np.arange(0,30,5))
-    df = pd.DataFrame({'Time':sol.t.reshape(-1),
-                       'Response':((c0-sol.y.T.reshape(-1))*np.random.uniform(0.1,0.12,size=len(sol.y.T))).round(decimals = 1)})
-    df.to_excel('./condition '+str(e)+'.xlsx',index=False)
+# the experiments are independent, so handle them together as arrays
+e_arr = expt_info['Expt'].values
+T = expt_info['Temperature'].values
+P = expt_info['Pressure'].values
+c0 = expt_info['Concentration'].values.astype(float)
+# k does not change with time, so dC/dt = k*C has the solution C = c0*exp(k*t)
+k = calc_rate_constant(P,T)
+t = np.arange(0,30,5)
+C = c0[:,None]*np.exp(k[:,None]*t)
+# draw the noise for every experiment and time at once
+response = ((c0[:,None]-C)*rng.uniform(0.1,0.12,size=C.shape)).round(decimals = 1)
 
-df.plot('Time','Response')
\ No newline at end of file
+for e,r in zip(e_arr,response):
+    df = pd.DataFrame({'Time':t,
+                       'Response':r})
+    df.to_excel('./condition '+str(e)+'.xlsx',index=False,engine='openpyxl')
+
+df.plot('Time','Response')
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Constants for reading the EPA's Toxic Release Inventory
+
+Used by EPA_TRI.py
+
+"""
+from types import MappingProxyType
+
+# descriptions of the TRI waste management codes, read-only so callers can't change them
+WM_DICT = MappingProxyType({'P91':'Waste water treatment',
+                            'M56':'Energy Recovery',
+                            'M50':'Incineration/Thermal Treatment',
+                            'M64':'Other Landfills',
+                            'M24':'Metals Recovery',
+                            'M26':'Other Reuse or Recovery',
+                            'M41':'Solidification/Stabilization - Metals and Metal Category Compounds only',
+                            'M90':'Other Off-Site Management',
+                            'M61':'Wastewater Treatment (Excluding POTW)',
+                            'M93':'Transfer to Waste Broker - Recycling ',
+                            'M92':'Transfer to Waste Broker - Energy Recovery',
+                            'M94':'Transfer to Waste Broker - Disposal',
+                            'M20':'Solvents/Organics Recovery',
+                            'M99':'Unknown',
+                            'M54':'Incineration/Insignificant Fuel Value ',
+                            'M95':'Transfer to Waste Broker - Waste Treatment',
+                            'M62':'Wastewater Treatment (Excluding POTW) - Metals and Metal Category Compounds only',
+                            'M79':'Other Land Disposal',
+                            'M65':'RCRA Subtitle C Landfills',
+                            'M69':'Other Waste Treatment',
+                            'M40':'Solidification/Stabilization',
+                            'M73':'Land Treatment',
+                            'M10':'Storage Only',
+                            'M81':'Underground Injection to Class I Wells',
+                            'M66':'Subtitle C Surface Impoundment',
+                            'M67':'Other Surface Impoundments',
+                            'M28':'Acid Regeneration',
+                            'M82':'Underground Injection to Class II- V Wells',
+                            'M72':'Landfill/Disposal Surface Impoundment'
+                           })